@@ -1,80 +1,348 @@
-import json
+import asyncio
 import os
 import signal
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 import tornado.websocket
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 from motor import MotorClient
+from pymongo import CursorType
+from pymongo.errors import PyMongoError
 from dotenv import load_dotenv
 from logzero import logger
+import bson
 from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from healthcheck import TornadoHandler, HealthCheck
 
 health = HealthCheck()
 
+# number of clients to send an update to, before yielding back to the event loop
+BROADCAST_BATCH_SIZE = 50
+# maximum number of changes coalesced into a single batch message
+MAX_BATCH_SIZE = 64
+# maximum time a change is held back, waiting for more changes to batch up
+MAX_LATENCY_MS = 10
+# number of changes buffered before the change stream gets throttled
+MAX_PENDING_CHANGES = 1024
+# number of updates a client may have not received yet, before it gets disconnected for not keeping up
+MAX_PENDING_UPDATES = 256
+# interval of re-loading the initial state snapshot from the database
+SNAPSHOT_REFRESH_INTERVAL_MS = 30_000
+# number of documents fetched per round trip, when loading the snapshot
+SNAPSHOT_BATCH_SIZE = 500
+# number of documents encoded at once, off the event loop, when loading the snapshot
+SNAPSHOT_ENCODE_CHUNK_SIZE = 256
+
+# encodes snapshot documents, so that the event loop can keep serving clients
+snapshot_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot")
+
+
+_dumps = orjson.dumps
+_default = json_util.default
+# datetimes are passed through, so that json_util renders them the same way as with the stdlib encoder
+_options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def dumps(message):
+    return _dumps(message, default=_default, option=_options)
+
+
+def dumps_message(operation, document):
+    # splice the already encoded document into the message, instead of encoding a wrapping dict
+    return b'{"operation":' + dumps(operation) + b',"document":' + document + b'}'
+
+
+def dumps_batch(messages):
+    # join already encoded messages into a single batch message
+    return b'{"operation":"batch","changes":[' + b",".join(messages) + b']}'
+
+
+def dumps_snapshot_documents(raw_documents):
+    # snapshot documents are fetched as raw BSON, so that they get decoded here, and not on the event loop
+    result = []
+    for raw_document in raw_documents:
+        document = bson.decode(raw_document.raw)
+        result.append((document["_id"], dumps_message("init", dumps(document))))
+    return result
+
 
 class ChangesHandler(tornado.websocket.WebSocketHandler):
-    connected_clients = set()
+    # handlers which get lost without being closed properly are dropped by the garbage collector
+    connected_clients = weakref.WeakSet()
+    pending_changes = None
+    # encoded "init" messages, by document id, or None if not loaded yet
+    snapshot_documents = None
+    # the encoded snapshot, sent to new clients, or None if it needs to be rebuilt
+    snapshot = None
+    # the load of the snapshot in progress, shared by everyone waiting for it
+    snapshot_load = None
+    # changes which came in while loading, replayed onto the loaded snapshot; None if the load is outdated
+    snapshot_replay = None
+    # maximum number of documents in the snapshot, 0 means unlimited
+    snapshot_limit = 0
     collection = None
+    projection = None
+    limit = 0
+    pending_updates = 0
 
     def initialize(self):
         self.collection = self.application.settings.get('collection')
-        logger.info(f"Collection: {self.collection}")
+        self.projection = self.application.settings.get('projection')
+        self.limit = self.application.settings.get('limit', 0)
+        logger.info("Collection: %s", self.collection)
 
     def check_origin(self, origin):
         return True
 
+    def get_compression_options(self):
+        # permessage-deflate compresses each message for every connection on its own, so encoding a message once
+        # still means compressing it once per client. None disables compression.
+        return self.application.settings.get('compression')
+
     async def send_current(self):
-        async for document in self.collection.find({}):
-            message = {
-                "operation": "init",
-                "document": document,
-            }
-            await self.write_message(json.dumps(message, default=json_util.default))
+        # the whole initial state is sent as a single (text) frame, containing one batch message
+        await self.write_message(await ChangesHandler.current_snapshot(self.collection, self.projection, self.limit))
+
+    @classmethod
+    def reload_snapshot(cls, collection, projection, limit):
+        if cls.snapshot_load is None:
+            cls.snapshot_load = asyncio.ensure_future(cls.load_snapshot(collection, projection, limit))
+        return cls.snapshot_load
+
+    @classmethod
+    async def load_snapshot(cls, collection, projection, limit):
+        cls.snapshot_limit = limit
+        replay = []
+        cls.snapshot_replay = replay
+        try:
+            documents = await cls.fetch_snapshot(collection, projection, limit)
+        finally:
+            cls.snapshot_load = None
+            outdated = cls.snapshot_replay is not replay
+            cls.snapshot_replay = None
+
+        if outdated:
+            # the collection was dropped or renamed while loading, hand out what we have, but don't keep it
+            return documents
+
+        for operation, key, message in replay:
+            cls.apply_to_documents(documents, operation, key, message)
+        cls.snapshot_documents = documents
+        cls.snapshot = None
+        return documents
+
+    @classmethod
+    async def fetch_snapshot(cls, collection, projection, limit):
+        documents = {}
+        cursor = collection.find({}, projection=projection) \
+            .sort("_id", -1) \
+            .limit(limit) \
+            .batch_size(SNAPSHOT_BATCH_SIZE)
+        loop = asyncio.get_running_loop()
+        chunk = []
+        async for document in cursor:
+            chunk.append(document)
+            if len(chunk) >= SNAPSHOT_ENCODE_CHUNK_SIZE:
+                documents.update(await loop.run_in_executor(snapshot_executor, dumps_snapshot_documents, chunk))
+                chunk = []
+        if chunk:
+            documents.update(await loop.run_in_executor(snapshot_executor, dumps_snapshot_documents, chunk))
+        # oldest first, so that new documents get appended, and the oldest ones get evicted first
+        return dict(reversed(documents.items()))
+
+    @classmethod
+    async def current_snapshot(cls, collection, projection, limit):
+        if cls.snapshot is not None:
+            return cls.snapshot
+
+        documents = cls.snapshot_documents
+        if documents is None:
+            # shielded, so that a client going away doesn't cancel the load for everyone else
+            documents = await asyncio.shield(cls.reload_snapshot(collection, projection, limit))
+
+        snapshot = dumps_batch(documents.values())
+        if documents is cls.snapshot_documents:
+            cls.snapshot = snapshot
+        return snapshot
+
+    @classmethod
+    def apply_to_documents(cls, documents, operation, key, message):
+        if message is None:
+            documents.pop(key, None)
+        elif key in documents or cls.snapshot_limit <= 0:
+            documents[key] = message
+        elif operation == "insert":
+            # a new document, which is now the most recent one
+            documents[key] = message
+            if len(documents) > cls.snapshot_limit:
+                del documents[next(iter(documents))]
+        # otherwise, the change is for a document outside the limited snapshot
+
+    @classmethod
+    def apply_to_snapshot(cls, change, document):
+        cls.snapshot = None
+
+        operation = change['operationType']
+        if operation in ("insert", "update", "replace", "delete"):
+            key = change['documentKey']['_id']
+            message = dumps_message("init", document) if document is not None else None
+            if cls.snapshot_replay is not None:
+                cls.snapshot_replay.append((operation, key, message))
+            if cls.snapshot_documents is not None:
+                cls.apply_to_documents(cls.snapshot_documents, operation, key, message)
+        else:
+            # drop, rename, invalidate, ...: start over
+            cls.snapshot_documents = None
+            cls.snapshot_replay = None
 
     async def open(self):
         ChangesHandler.connected_clients.add(self)
         await self.send_current()
 
     def on_close(self):
-        ChangesHandler.connected_clients.remove(self)
+        ChangesHandler.connected_clients.discard(self)
+
+    def send_update(self, payload: bytes):
+        # don't wait for the update to be flushed, a slow client must not hold back the others
+        if self.pending_updates >= MAX_PENDING_UPDATES:
+            logger.info("Client is not keeping up, closing connection")
+            ChangesHandler.connected_clients.discard(self)
+            self.close()
+            return
+
+        try:
+            future = self.write_message(payload)
+        except tornado.websocket.WebSocketClosedError:
+            ChangesHandler.connected_clients.discard(self)
+            return
+
+        self.pending_updates += 1
+        future.add_done_callback(self.on_update_sent)
+
+    def on_update_sent(self, future):
+        self.pending_updates -= 1
+        if future.cancelled() or future.exception() is not None:
+            # all pending updates of a client fail at once, only log the first one
+            if self in ChangesHandler.connected_clients:
+                logger.info("Failed to send update, dropping client")
+                ChangesHandler.connected_clients.discard(self)
 
     @classmethod
-    def send_updates(cls, message):
-        logger.debug(f"sending update: {message} to {len(cls.connected_clients)} clients")
-        for connected_client in cls.connected_clients:
-            connected_client.write_message(message)
+    async def send_updates(cls, payload: bytes):
+        logger.debug("sending update: %d bytes to %d clients", len(payload), len(cls.connected_clients))
+        # the payload is encoded once, and the same buffer is handed to every client
+        clients = []
+        for client in tuple(cls.connected_clients):
+            if client.ws_connection is None or client.ws_connection.is_closing():
+                cls.connected_clients.discard(client)
+            else:
+                clients.append(client)
+
+        for i in range(0, len(clients), BROADCAST_BATCH_SIZE):
+            for client in clients[i:i + BROADCAST_BATCH_SIZE]:
+                client.send_update(payload)
+            # let other handlers (like new connections) run between batches
+            await asyncio.sleep(0)
 
     @classmethod
-    def on_change(cls, change):
-        message = {
-            "operation": change['operationType'],
-            "document": change['fullDocument'],
-        }
-        ChangesHandler.send_updates(json.dumps(message, default=json_util.default))
-
+    async def on_change(cls, change):
+        # the document is encoded once, for both the update and the snapshot
+        document = change.get('fullDocument')
+        if document is not None:
+            document = dumps(document)
+        cls.apply_to_snapshot(change, document)
+        await cls.pending_changes.put(dumps_message(change['operationType'], document or b'null'))
 
+    @classmethod
+    async def broadcast_changes(cls):
+        loop = asyncio.get_running_loop()
+        while True:
+            changes = [await cls.pending_changes.get()]
+            deadline = loop.time() + MAX_LATENCY_MS / 1000
+            while len(changes) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    changes.append(await asyncio.wait_for(cls.pending_changes.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            if len(changes) == 1:
+                payload: bytes = changes[0]
+            else:
+                payload: bytes = dumps_batch(changes)
+            await cls.send_updates(payload)
+
+
+# the change stream, or tailable cursor, currently being followed, closed on shutdown
 change_stream = None
 
 
-async def watch(collection):
+def change_projection(projection):
+    # only fetch the fields of a change event which are actually sent to the clients, with the document trimmed
+    # the same way as the snapshot documents. the _id (resume token) is kept implicitly.
+    if projection is None:
+        return {"operationType": 1, "fullDocument": 1, "documentKey": 1}
+
+    fields = {"operationType": 1, "documentKey": 1, "fullDocument._id": 1}
+    fields.update({"fullDocument." + field: 1 for field in projection})
+    return fields
+
+
+async def watch(collection, projection, batch_size, max_await_time_ms):
     global change_stream
 
-    async with collection.watch(full_document="updateLookup") as change_stream:
+    async with collection.watch([{"$project": change_projection(projection)}],
+                                full_document="updateLookup",
+                                batch_size=batch_size,
+                                max_await_time_ms=max_await_time_ms) as change_stream:
         async for change in change_stream:
-            ChangesHandler.on_change(change)
+            await ChangesHandler.on_change(change)
+
+
+# follow a capped collection of change events, as a cheaper alternative to a change stream. the events must have
+# the same structure as change stream events: operationType, documentKey and fullDocument.
+async def tail(events, projection, max_await_time_ms):
+    global change_stream
+
+    # only process events which arrive from now on
+    last = await events.find_one({}, sort=[("$natural", -1)], projection={"_id": 1})
+    last_id = None if last is None else last["_id"]
+
+    while True:
+        try:
+            # resume after the last processed event by its position, as the _ids of different producers
+            # don't need to be in order
+            skip = last_id is not None and await events.find_one({"_id": last_id}, projection={"_id": 1}) is not None
+            if last_id is not None and not skip:
+                logger.warning("Last processed event is no longer available, events may have been missed")
+
+            change_stream = events.find({}, projection=change_projection(projection),
+                                        cursor_type=CursorType.TAILABLE_AWAIT) \
+                .max_await_time_ms(max_await_time_ms)
+            async for event in change_stream:
+                if skip:
+                    skip = event["_id"] != last_id
+                    continue
+                last_id = event["_id"]
+                await ChangesHandler.on_change(event)
+        except PyMongoError as e:
+            # e.g. the capped collection overwrote our position, or the server is not reachable
+            logger.warning("Failed to tail events collection: %r", e)
+        # the cursor is dead, e.g. because the collection was empty, try again
+        await asyncio.sleep(1)
 
 
 class HomeHandler(tornado.web.RequestHandler):
     def get(self):
-        self.render("templates/index.html",
-                    simulator_url=os.getenv("SIMULATOR_URL", ""),
-                    socket_override_url=os.getenv("SOCKET_OVERRIDE_URL", ""),
-                    title=os.getenv("INDEX__TITLE", "Dashboard"),
-                    cols=os.getenv("INDEX__COLS", "row-cols-1 row-cols-md-2 row-cols-xl-4 g-4")
-                    )
+        self.render("templates/index.html", **self.application.settings["ui"])
 
 
 def sig_handler(sig, frame):
@@ -83,6 +351,12 @@ def sig_handler(sig, frame):
 
 
 def main():
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not available, using the default event loop")
+
     load_dotenv()
 
     database = os.environ["DATABASE"]
@@ -90,12 +364,52 @@ def main():
 
     logger.info('Database: %s, collection: %s', database, application)
 
-    client = MotorClient(os.environ["MONGODB__URL"])
+    # fields of the documents sent to clients, an empty value sends all fields
+    projection = os.getenv("SEND_CURRENT__PROJECTION", "device,features,payload")
+    projection = {field.strip(): 1 for field in projection.split(",") if field.strip()} or None
+
+    # maximum number of (most recently created) documents sent to new clients, 0 means unlimited
+    limit = int(os.getenv("SEND_CURRENT__MAX_DOCUMENTS", "0"))
+
+    change_stream_batch_size = int(os.getenv("CHANGE_STREAM__BATCH_SIZE", "500"))
+    change_stream_max_await_ms = int(os.getenv("CHANGE_STREAM__MAX_AWAIT_MS", "500"))
+    # permessage-deflate, trading CPU (per client and message) for less traffic
+    compression = None
+    if os.getenv("WEBSOCKET__COMPRESSION", "true").lower() == "true":
+        compression = {
+            "compression_level": int(os.getenv("WEBSOCKET__COMPRESSION_LEVEL", "3")),
+            "mem_level": int(os.getenv("WEBSOCKET__COMPRESSION_MEM_LEVEL", "5")),
+        }
+
+    # capped collection to tail for changes, instead of using a change stream
+    events_collection = os.getenv("EVENTS_COLLECTION", "")
+
+    client = MotorClient(os.environ["MONGODB__URL"], minPoolSize=4, maxPoolSize=16)
     collection = client[database][application]
+    snapshot_collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
 
     global app
     global loop
 
+    loop = tornado.ioloop.IOLoop.current()
+
+    # fail early on a broken configuration, using a short-lived client with a short timeout. the long-lived client
+    # keeps the default server selection timeout, which outlasts replica set elections.
+    probe = MotorClient(os.environ["MONGODB__URL"], serverSelectionTimeoutMS=3000)
+    try:
+        loop.run_sync(lambda: probe.admin.command('ping'))
+    finally:
+        probe.close()
+    # warm up the connection pool before accepting clients
+    loop.run_sync(lambda: client.admin.command('ping'))
+    logger.info("Connected to MongoDB")
+
+    if events_collection != "":
+        events = client[database][events_collection]
+        # tailable cursors only work on capped collections
+        if not loop.run_sync(events.options).get("capped", False):
+            raise ValueError(f"Events collection is not a capped collection: {events_collection}")
+
     app = tornado.web.Application(
         [
             (r"/socket", ChangesHandler),
@@ -111,7 +425,16 @@ def main():
                 {"path": "templates/", "default_filename": "index.html"}
             )
         ],
-        collection=collection
+        collection=snapshot_collection,
+        projection=projection,
+        limit=limit,
+        compression=compression,
+        ui=dict(
+            simulator_url=os.getenv("SIMULATOR_URL", ""),
+            socket_override_url=os.getenv("SOCKET_OVERRIDE_URL", ""),
+            title=os.getenv("INDEX__TITLE", "Dashboard"),
+            cols=os.getenv("INDEX__COLS", "row-cols-1 row-cols-md-2 row-cols-xl-4 g-4")
+        )
     )
 
     app.listen(8082)
@@ -120,8 +443,19 @@ def main():
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
-    loop = tornado.ioloop.IOLoop.current()
-    loop.add_callback(watch, collection)
+    ChangesHandler.pending_changes = asyncio.Queue(maxsize=MAX_PENDING_CHANGES)
+    tornado.ioloop.PeriodicCallback(
+        lambda: ChangesHandler.reload_snapshot(snapshot_collection, projection, limit),
+        SNAPSHOT_REFRESH_INTERVAL_MS
+    ).start()
+    # load the snapshot ahead of the first client connecting
+    loop.add_callback(ChangesHandler.reload_snapshot, snapshot_collection, projection, limit)
+    loop.add_callback(ChangesHandler.broadcast_changes)
+    if events_collection != "":
+        logger.info('Following events collection: %s', events_collection)
+        loop.add_callback(tail, events, projection, change_stream_max_await_ms)
+    else:
+        loop.add_callback(watch, collection, projection, change_stream_batch_size, change_stream_max_await_ms)
 
     try:
         loop.start()
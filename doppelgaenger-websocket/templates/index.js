@@ -5,6 +5,11 @@ function encodeDevice(device) {
 function updateDevice(update) {
     //console.log(update)
 
+    if (!update.document) {
+        // e.g. a delete, which doesn't carry a document
+        return;
+    }
+
     const device = update.document.device;
     const state = update.document;
     const cardId = "device-card-" + encodeDevice(device);